@@ -5,78 +5,196 @@
 import streamlit as st
 import pandas as pd
 import zipfile
-import xml.etree.ElementTree as ET
-import re
+import xlsxwriter
+import lxml.etree as ET
 import io
+import bisect
+import itertools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from patterns import (
+    DONG_RE, NUM_RE, FLOOR_RE, FLOOR_NUM_RE,
+    FLOOR_BDR_RE, BASEMENT_HDR_RE, SPECIAL_RE, EXCLUDE_RE,
+)
 
 # ===== HWPX 파싱 함수들 =====
 NS = {'hwp': 'http://www.hancom.co.kr/hwpml/2011/paragraph'}
 
+# iterparse가 구독할 표 태그 (네임스페이스 유무 모두)
+_TBL_TAGS = (f'{{{NS["hwp"]}}}tbl', 'tbl')
+
+def _classify_dong_rows(all_rows):
+    """동 데이터의 각 행을 한 번만 분류해 (종류, 층번호, 지하여부)로 반환
+
+    종류: 'skip'(입면도 구간/제외 키워드), 'header'(층 헤더), 'data'(일반 행).
+    층 헤더가 시작 패턴에 안 맞으면 층번호는 None (캡처 시작 불가, 경계로만 동작)
+    """
+    classes = []
+    skip_section = False
+    for row in all_rows:
+        row_text = ' '.join('' if cell is None else str(cell) for cell in row)
+
+        # 정면도/배면도 스킵 구간: 다음 층 헤더가 나올 때까지 건너뜀
+        if '정면도' in row_text or '배면도' in row_text:
+            skip_section = True
+            classes.append(('skip', None, False))
+            continue
+
+        is_boundary = FLOOR_BDR_RE.search(row_text) is not None
+        if is_boundary:
+            skip_section = False
+        if skip_section or EXCLUDE_RE.search(row_text):
+            classes.append(('skip', None, False))
+            continue
+
+        if is_boundary:
+            bm = BASEMENT_HDR_RE.search(row_text)
+            if bm:
+                classes.append(('header', int(bm.group(1)), True))
+            else:
+                gm = FLOOR_RE.search(row_text)
+                if gm and '지하' not in row_text and 'B' not in row_text:
+                    classes.append(('header', int(gm.group(1)), False))
+                else:
+                    classes.append(('header', None, False))
+            continue
+
+        classes.append(('data', None, False))
+    return classes
+
+# 태그별 (네임스페이스, 비네임스페이스) 이름 쌍을 미리 구성
+# iterdescendants가 C 레벨에서 필터링하므로 트리를 한 번만 걷고 중간 리스트도 안 만듦
+_TAG_PAIRS = {
+    tag: (f'{{{NS["hwp"]}}}{tag}', tag)
+    for tag in ('tbl', 'tr', 'tc', 't')
+}
+
 def find_elements(parent, tag):
     """네임스페이스 있든 없든 요소 찾기"""
-    elements = parent.findall(f'.//{tag}')
-    if not elements:
-        elements = parent.findall(f'.//hwp:{tag}', NS)
-    return elements
+    return parent.iterdescendants(*_TAG_PAIRS[tag])
 
 def get_text(element):
     """요소에서 모든 텍스트 추출"""
     texts = [t.text for t in find_elements(element, 't') if t.text]
     return ' '.join(texts)
 
+# 셀 텍스트는 반복이 심하므로(mm, EA, 층 헤더 등) 짧은 문자열은 한 객체로 공유
+_text_cache = {}
+
+def _intern_text(text):
+    """짧은 셀 텍스트를 캐시해 중복 str 할당을 줄임"""
+    if len(text) < 32:
+        return _text_cache.setdefault(text, text)
+    return text
+
 def extract_table_data(table):
     """표를 2차원 리스트로 변환"""
     rows_data = []
     for row in find_elements(table, 'tr'):
-        row_data = [get_text(cell).strip() for cell in find_elements(row, 'tc')]
+        row_data = [_intern_text(get_text(cell).strip()) for cell in find_elements(row, 'tc')]
         if row_data:
             rows_data.append(row_data)
     return rows_data
 
-def extract_tables_from_hwpx(hwpx_path):
-    """HWPX 파일에서 모든 표 추출"""
+def _parse_section_bytes(data):
+    """섹션 XML 바이트에서 표 데이터 추출 (스레드 워커)"""
+    tables = []
+    for _, table in ET.iterparse(io.BytesIO(data), events=('end',), tag=_TBL_TAGS,
+                                 huge_tree=True, collect_ids=False):
+        # 셀 안에 중첩된 표는 end 이벤트가 먼저 오지만 여기서 비우면
+        # 아직 안 읽은 바깥 셀 내용이 같이 지워짐 — 최상위 표에서만 처리
+        if any(a.tag in _TBL_TAGS for a in table.iterancestors()):
+            continue
+
+        # 최상위 표와 그 안의 중첩 표를 문서 순서(.//tbl 선순회)대로 추출
+        for tbl in itertools.chain((table,), find_elements(table, 'tbl')):
+            table_data = extract_table_data(tbl)
+            if table_data:
+                tables.append(table_data)
+
+        # 처리 끝난 표와 앞쪽 형제를 비워 메모리를 표 하나 수준으로 유지
+        table.clear(keep_tail=True)
+        while table.getprevious() is not None:
+            del table.getparent()[0]
+    return tables
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def extract_tables_from_hwpx(file_bytes):
+    """HWPX 파일 바이트에서 모든 표 추출 (파일 내용 기준으로 캐시됨)"""
+    with zipfile.ZipFile(io.BytesIO(file_bytes), 'r') as z:
+        # 사전순 정렬된 이름 목록에서 'Contents/section' 접두사 구간을 이진 탐색으로 잘라냄
+        # ('sectioo'는 접두사 다음 문자열 — 구간 상한 트릭)
+        # 이 사전순 정렬은 구간을 찾기 위한 것일 뿐, 파싱 순서는 아래에서 번호순으로 맞춤
+        names = sorted(z.namelist())
+        lo = bisect.bisect_left(names, 'Contents/section')
+        hi = bisect.bisect_left(names, 'Contents/sectioo')
+        # 섹션 이름을 단 XML 아닌 부속 파일이 섞여 있어도 건너뜀
+        section_files = [n for n in names[lo:hi] if n.endswith('.xml')]
+        # 사전순은 section10이 section2보다 앞서므로 섹션 번호 순으로 재정렬해야
+        # 동 그룹화/층 스캔이 문서 순서를 따라감 (번호 없는 이름은 안정 정렬로 맨 앞 유지)
+        section_files.sort(key=lambda n: int(m.group()) if (m := NUM_RE.search(n)) else -1)
+        # ZipFile은 동시 open이 안전하지 않으므로 읽기는 직렬로
+        # 길이 0짜리 엔트리(디렉터리 표기 등)는 파서에 넘기지 않음
+        section_bytes = [data for data in (z.read(f) for f in section_files) if data]
+
+    if not section_bytes:
+        return []
+
+    # lxml 파싱은 GIL을 풀기 때문에 섹션 단위 스레드 병렬화가 유효함
     all_tables = []
-    with zipfile.ZipFile(hwpx_path, 'r') as z:
-        for section_file in [f for f in z.namelist() if f.startswith('Contents/section')]:
-            with z.open(section_file) as f:
-                root = ET.parse(f).getroot()
-                for table in find_elements(root, 'tbl'):
-                    table_data = extract_table_data(table)
-                    if table_data:
-                        all_tables.append(table_data)
+    with ThreadPoolExecutor(max_workers=min(8, len(section_bytes))) as ex:
+        for tables in ex.map(_parse_section_bytes, section_bytes):
+            all_tables.extend(tables)
     return all_tables
 
+@st.cache_data(show_spinner=False, max_entries=4)
 def group_by_dong(all_tables):
     """표 데이터를 동별로 그룹화"""
+    all_rows = [row for table in all_tables for row in table]
+    if not all_rows:
+        return {}
+
+    # 행 텍스트를 한 번만 만들고 동 번호 추출/전파/그룹화는 pandas C 루프로 처리
+    texts = pd.Series([' '.join(row) for row in all_rows])
+    dong_nums = texts.str.extract(DONG_RE, expand=False).ffill()
+    rows_series = pd.Series(all_rows, dtype=object)
+
     dong_data = {}
-    current_dong = None
-    for table in all_tables:
-        for row in table:
-            match = re.search(r'(\d+)동', ' '.join(row))
-            if match:
-                current_dong = f"{match.group(1)}동"
-                if current_dong not in dong_data:
-                    dong_data[current_dong] = []
-            if current_dong:
-                dong_data[current_dong].append(row)
+    matched = dong_nums.notna()
+    for dong_num, rows in rows_series[matched].groupby(dong_nums[matched], sort=False):
+        dong_data[f"{dong_num}동"] = rows.tolist()
     return dong_data
 
 def filter_by_floor_range(rows, start_floor, end_floor):
     """특정 층 범위에 해당하는 행만 필터링"""
     filtered_rows = []
+    seen_ids = set()
     for row in rows:
         row_text = ' '.join([str(cell) for cell in row if cell])
-        # 숫자층 검색
-        for floor_num in range(start_floor, end_floor + 1):
-            if f"{floor_num}층" in row_text or f"[ {floor_num}층" in row_text:
-                filtered_rows.append(row)
-                break
+        rid = id(row)
+        # 층 번호를 한 번만 추출해 범위 비교 (층마다 부분문자열 검색하지 않음)
+        match = FLOOR_NUM_RE.search(row_text)
+        if match and start_floor <= int(match.group(1)) <= end_floor:
+            seen_ids.add(rid)
+            filtered_rows.append(row)
         # 옥탑/지붕층 (15층 이상)
-        if end_floor >= 15 and any(kw in row_text for kw in ["옥탑", "지붕"]):
-            if row not in filtered_rows:
+        if end_floor >= 15 and SPECIAL_RE.search(row_text):
+            if rid not in seen_ids:
+                seen_ids.add(rid)
                 filtered_rows.append(row)
     return filtered_rows
 
+def _sorted_dongs(dong_data):
+    """동 이름을 번호 기준으로 정렬 (리런당 한 번만 계산해 재사용)"""
+    return sorted(dong_data.keys(), key=lambda x: int(NUM_RE.search(x).group()))
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _preview_df(rows):
+    """미리보기용 DataFrame (행 내용 기준으로 캐시, 리런마다 재생성 방지)"""
+    # 열 단위 dict로 구성하면 column-major 저장이 되고 들쭉날쭉한 행 패딩도 같이 처리됨
+    columns = itertools.zip_longest(*rows, fillvalue='')
+    return pd.DataFrame({i: list(col) for i, col in enumerate(columns)})
+
 # ===== Streamlit 앱 시작 =====
 
 st.set_page_config(page_title="HWPX 분석기", layout="wide")
@@ -89,23 +207,45 @@ if 'dong_data' not in st.session_state:
 if 'floor_ranges' not in st.session_state:
     st.session_state.floor_ranges = {}
 
+# 버튼 콜백들: 리런 전에 실행되므로 별도의 st.rerun() 호출이 필요 없음
+def _add_floor(dong_name):
+    floor_name = st.session_state.get(f"floor_name_{dong_name}", "")
+    if not floor_name:
+        return
+    ranges = st.session_state.floor_ranges.setdefault(dong_name, {})
+    ranges[floor_name] = {
+        'floor_type': st.session_state[f"floor_type_{dong_name}"],
+        'start_floor': int(st.session_state[f"start_floor_{dong_name}"]),
+        'end_floor': int(st.session_state[f"end_floor_{dong_name}"]),
+    }
+
+def _delete_floor(dong_name, floor_name):
+    st.session_state.floor_ranges.get(dong_name, {}).pop(floor_name, None)
+
+def _reset_all():
+    st.session_state.floor_ranges = {}
+    st.session_state.dong_data = {}
+    st.session_state.sorted_dongs = []
+
 # 파일 업로드
 uploaded_file = st.file_uploader("HWPX 파일 업로드", type=['hwpx'])
 
 if uploaded_file:
     with st.spinner("파일 분석 중..."):
         # 표 추출
-        tables_data = extract_tables_from_hwpx(uploaded_file)
+        tables_data = extract_tables_from_hwpx(uploaded_file.getvalue())
         st.success(f"✅ {len(tables_data)}개의 표를 발견했습니다")
         
         # 동별로 파싱
         dong_data = group_by_dong(tables_data)
         st.session_state.dong_data = dong_data
-        
+        # 정렬 결과는 selectbox와 엑셀 내보내기가 함께 사용
+        st.session_state.sorted_dongs = _sorted_dongs(dong_data)
+
         st.info(f"📊 총 {len(dong_data)}개의 동을 발견했습니다: {', '.join(sorted(dong_data.keys()))}")
     
     # 동 선택
-    selected_dong = st.selectbox("동 선택", sorted(dong_data.keys(), key=lambda x: int(re.search(r'\d+', x).group())))
+    selected_dong = st.selectbox("동 선택", st.session_state.sorted_dongs)
     
     if selected_dong:
         dong_rows = dong_data[selected_dong]
@@ -114,8 +254,9 @@ if uploaded_file:
         
         # 데이터 미리보기 (디버깅용)
         with st.expander("🔍 원본 데이터 미리보기"):
-            df_preview = pd.DataFrame(dong_rows)
-            st.dataframe(df_preview.head(100), use_container_width=True)
+            # 미리보기 분량만 잘라서 DataFrame을 만듦 (전체 구성은 내보내기 때까지 불필요)
+            df_preview = _preview_df(dong_rows[:100])
+            st.dataframe(df_preview, use_container_width=True)
             
             # 첫 번째 셀 값들만 확인
             st.markdown("**첫 번째 열 값들:**")
@@ -128,28 +269,22 @@ if uploaded_file:
         with st.form(f"add_floor_{selected_dong}"):
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                floor_name = st.text_input("층 이름", placeholder="예: 저층부")
+                st.text_input("층 이름", placeholder="예: 저층부", key=f"floor_name_{selected_dong}")
             with col2:
-                floor_type = st.selectbox("구분", ["지상", "지하"])
+                st.selectbox("구분", ["지상", "지하"], key=f"floor_type_{selected_dong}")
             with col3:
-                start_floor = st.number_input("시작 층", min_value=1, max_value=100, value=1)
+                st.number_input("시작 층", min_value=1, max_value=100, value=1, key=f"start_floor_{selected_dong}")
             with col4:
-                end_floor = st.number_input("끝 층", min_value=1, max_value=100, value=8)
-            
-            submitted = st.form_submit_button("층 추가")
-            
-            if submitted and floor_name:
-                if selected_dong not in st.session_state.floor_ranges:
-                    st.session_state.floor_ranges[selected_dong] = {}
-                
-                st.session_state.floor_ranges[selected_dong][floor_name] = {
-                    'floor_type': floor_type,
-                    'start_floor': int(start_floor),
-                    'end_floor': int(end_floor)
-                }
-                floor_display = f"{floor_type} {start_floor}층 ~ {end_floor}층"
-                st.success(f"✅ {floor_name} 추가됨 ({floor_display})")
-                st.rerun()
+                st.number_input("끝 층", min_value=1, max_value=100, value=8, key=f"end_floor_{selected_dong}")
+
+            submitted = st.form_submit_button("층 추가", on_click=_add_floor, args=(selected_dong,))
+
+            if submitted:
+                added_name = st.session_state.get(f"floor_name_{selected_dong}", "")
+                added = st.session_state.floor_ranges.get(selected_dong, {}).get(added_name)
+                if added:
+                    floor_display = f"{added['floor_type']} {added['start_floor']}층 ~ {added['end_floor']}층"
+                    st.success(f"✅ {added_name} 추가됨 ({floor_display})")
         
         # 설정된 층 범위 표시
         if selected_dong in st.session_state.floor_ranges:
@@ -161,97 +296,75 @@ if uploaded_file:
                     floor_type = range_info.get('floor_type', '지상')
                     st.write(f"**{floor_name}**: {floor_type} {range_info['start_floor']}층 ~ {range_info['end_floor']}층")
                 with col2:
-                    if st.button("삭제", key=f"del_{selected_dong}_{floor_name}"):
-                        del st.session_state.floor_ranges[selected_dong][floor_name]
-                        st.rerun()
+                    st.button("삭제", key=f"del_{selected_dong}_{floor_name}",
+                              on_click=_delete_floor, args=(selected_dong, floor_name))
 
 # 엑셀 다운로드
 st.markdown("---")
 st.subheader("💾 엑셀 파일 생성")
 
 def make_excel_bytes():
-    output = io.BytesIO()
-
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        for dong_name in sorted(
-            st.session_state.dong_data.keys(),
-            key=lambda x: int(re.search(r'\d+', x).group())
-        ):
-            rows = st.session_state.dong_data[dong_name]
-            df = pd.DataFrame(rows)
-
-            if dong_name in st.session_state.floor_ranges:
-                combined_data = []
-
-                for floor_name, range_info in st.session_state.floor_ranges[dong_name].items():
-                    floor_type = range_info.get('floor_type', '지상')
-                    start_floor = range_info['start_floor']
-                    end_floor = range_info['end_floor']
-
-                    # 제목 행
-                    title_row = [f"[ {floor_name} ]"] + [''] * (df.shape[1] - 1)
-                    combined_data.append(title_row)
-
-                    all_rows = df.values.tolist()
-
-                    for floor_num in range(start_floor, end_floor + 1):
-                        floor_rows = []
-                        capturing = False
-                        skip_section = False
-
-                        for row in all_rows:
-                            row_text = ' '.join([str(cell) if cell is not None else '' for cell in row])
-
-                            # 정면도/배면도 스킵
-                            if '정면도' in row_text or '배면도' in row_text:
-                                skip_section = True
-                                continue
-
-                            if re.search(r'\d+동\s*\d+층|\d+동\s*(지하|B)\s*\d+층', row_text):
-                                skip_section = False
-
-                            if skip_section:
-                                continue
-
-                            # 제외 키워드 필터
-                            exclude_keywords = [
-                                '부록','외관조사망도','참조','번 호',
-                                '부   위','부 재','폭','mm','길이','개소','EA'
-                            ]
-                            if any(k in row_text for k in exclude_keywords):
-                                continue
-
-                            if floor_type == "지하":
-                                if re.search(rf'\d+동\s*(지하|B)\s*{floor_num}층', row_text):
-                                    capturing = True
-                                    floor_rows.append(row)
-                                    continue
-
-                                if capturing and re.search(r'\d+동\s*\d+층|\d+동\s*(지하|B)\s*\d+층', row_text):
-                                    break
-
-                            else:
-                                match = re.search(rf'\d+동\s*(\d+)층', row_text)
-                                if match and "지하" not in row_text and "B" not in row_text:
-                                    if int(match.group(1)) == floor_num:
-                                        capturing = True
-                                        floor_rows.append(row)
-                                        continue
-
-                                if capturing and re.search(r'\d+동\s*\d+층|\d+동\s*(지하|B)\s*\d+층', row_text):
-                                    break
-
-                            if capturing:
-                                floor_rows.append(row)
-
-                        if floor_rows:
-                            combined_data.extend(floor_rows)
-
-                combined_df = pd.DataFrame(combined_data)
-                combined_df.to_excel(writer, sheet_name=dong_name[:31], index=False, header=False)
-
+    # 큰 워크북이 메모리에 다 쌓이지 않도록 디스크 스풀로 직렬화
+    output = tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024)
+
+    # constant_memory 모드는 행을 쓰는 즉시 스풀로 직렬화하고 버림
+    wb = xlsxwriter.Workbook(output, {'constant_memory': True})
+
+    sorted_dongs = st.session_state.get('sorted_dongs') or _sorted_dongs(st.session_state.dong_data)
+    for dong_name in sorted_dongs:
+        rows = st.session_state.dong_data[dong_name]
+
+        if dong_name in st.session_state.floor_ranges:
+            # 행 분류는 동마다 한 번만 수행하고 층 루프는 분류 결과만 읽음
+            # (DataFrame을 거치지 않고 들쭉날쭉한 행만 직접 None 패딩)
+            ncols = max(map(len, rows), default=0)
+            all_rows = [
+                row if len(row) == ncols else row + [None] * (ncols - len(row))
+                for row in rows
+            ]
+            row_classes = _classify_dong_rows(all_rows)
+
+            # 행을 모았다가 한꺼번에 쓰는 대신 만들어지는 즉시 시트로 흘려보냄
+            # (constant_memory는 행 순서대로만 쓰면 됨 — 현재 흐름이 그 조건을 만족)
+            ws = wb.add_worksheet(dong_name[:31])
+            next_row = 0
+            title_pad = [''] * (ncols - 1)
+
+            for floor_name, range_info in st.session_state.floor_ranges[dong_name].items():
+                floor_type = range_info.get('floor_type', '지상')
+                start_floor = range_info['start_floor']
+                end_floor = range_info['end_floor']
+                wanted_basement = floor_type == "지하"
+
+                # 제목 행
+                ws.write_row(next_row, 0, [f"[ {floor_name} ]"] + title_pad)
+                next_row += 1
+
+                for floor_num in range(start_floor, end_floor + 1):
+                    capturing = False
+
+                    for row, (kind, header_num, is_basement) in zip(all_rows, row_classes):
+                        if kind == 'skip':
+                            continue
+
+                        if kind == 'header':
+                            if header_num == floor_num and is_basement == wanted_basement:
+                                capturing = True
+                                ws.write_row(next_row, 0, row)
+                                next_row += 1
+                            elif capturing:
+                                break
+                            continue
+
+                        if capturing:
+                            ws.write_row(next_row, 0, row)
+                            next_row += 1
+
+    wb.close()
     output.seek(0)
-    return output.getvalue()
+    data = output.read()
+    output.close()
+    return data
 
 # ===== 다운로드 버튼 스타일 (여기에 넣기) =====
 st.markdown(
@@ -304,7 +417,4 @@ with st.sidebar:
     else:
         st.info("아직 설정된 층 범위가 없습니다")
     
-    if st.button("🔄 모두 초기화", use_container_width=True):
-        st.session_state.floor_ranges = {}
-        st.session_state.dong_data = {}
-        st.rerun()
+    st.button("🔄 모두 초기화", use_container_width=True, on_click=_reset_all)
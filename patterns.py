@@ -0,0 +1,23 @@
+"""
+HWPX 분석 스크립트들이 공유하는 컴파일된 정규식 모음
+- 패턴 컴파일은 프로세스당 한 번만 수행됨
+- 정규식 엔진 교체(re2 등)가 필요해지면 이 모듈만 고치면 됨
+"""
+import re
+
+# 동/층 헤더
+DONG_RE = re.compile(r'(\d+)동')
+NUM_RE = re.compile(r'\d+')
+FLOOR_RE = re.compile(r'\d+동\s*(\d+)층')
+FLOOR_NUM_RE = re.compile(r'(\d+)\s*층')
+FLOOR_BDR_RE = re.compile(r'\d+동\s*\d+층|\d+동\s*(?:지하|B)\s*\d+층')
+BASEMENT_HDR_RE = re.compile(r'\d+동\s*(?:지하|B)\s*(\d+)층')
+
+# 옥탑/지붕 특수층
+SPECIAL_RE = re.compile(r'옥탑|지붕')
+
+# 엑셀 생성 시 걸러낼 안내/부록성 행 키워드 (한 번의 스캔으로 검사하도록 단일 패턴화)
+EXCLUDE_RE = re.compile('|'.join(map(re.escape, [
+    '부록', '외관조사망도', '참조', '번 호',
+    '부   위', '부 재', '폭', 'mm', '길이', '개소', 'EA'
+])))